@@ -1,36 +1,109 @@
 import json
 import os
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 
+_CACHE_FILE = "tile_counts.cache.json"
+_LABELS = ("tumor", "non_tumor")
 
-def main(config_path):
+
+def _count(path):
+    with os.scandir(path) as it:
+        return sum(1 for _ in it)
+
+
+def _count_cached(path, cached):
+    # Adding or removing tiles updates the directory mtime, so an unchanged mtime means an unchanged count.
+    # Stat before counting, such that tiles written during the scan invalidate the entry on the next run.
+    mtime_ns = os.stat(path).st_mtime_ns
+    if cached is not None and cached[1] == mtime_ns:
+        return cached
+    return [_count(path), mtime_ns]
+
+
+def load_cache(tile_path):
+    try:
+        with open(os.path.join(tile_path, _CACHE_FILE)) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(tile_path, cache):
+    # The cache is optional, a read-only or shared dataset directory must not fail the report
+    file = os.path.join(tile_path, _CACHE_FILE)
+    try:
+        with open(file + ".tmp", "w") as json_file:
+            json.dump(cache, json_file)
+        os.replace(file + ".tmp", file)
+    except OSError as e:
+        print(f"Warning: could not write tile count cache {file}: {e}")
+    finally:
+        # Nothing is left after a successful replace, otherwise drop the partial file
+        try:
+            os.remove(file + ".tmp")
+        except OSError:
+            pass
+
+
+def main(config_path, max_workers=32, use_cache=True):
     with open(config_path) as json_file:
         config = json.load(json_file)
     tile_path = config["output_path"]
 
+    cache = load_cache(tile_path) if use_cache else {}
+
     total_tumor = 0
     total_tiles = 0
-    slides = sorted([f for f in os.listdir(tile_path) if os.path.isdir(os.path.join(tile_path, f))])
-    for i in range(len(slides)):
-        slide = slides[i]
-        slide_path = os.path.join(tile_path, slide)
-        n_tumor = len(os.listdir(os.path.join(slide_path, "tumor")))
-        n_other = len(os.listdir(os.path.join(slide_path, "non_tumor")))
-        n_total = n_tumor + n_other
-        frac = n_tumor / n_total * 100
-        print(f"{i}: {n_tumor}/{n_total}, {frac:.4f}% tumor tiles of total tiles, name: {slide}")
-        total_tumor += n_tumor
-        total_tiles += n_total
-    frac = total_tumor / total_tiles * 100
+    with os.scandir(tile_path) as it:
+        # DirEntry.is_dir() reuses the file type from the directory read, no extra stat per entry
+        slides = sorted((e for e in it if e.is_dir()), key=lambda e: e.name)
+
+    # Directory listings are I/O bound, so keep several of them in flight (helps a lot on network storage).
+    # Every label directory is a separate task, such that both labels of a slide are counted concurrently.
+    # Results are printed as soon as a slide is complete, the index refers to the sorted slide order.
+    new_cache = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(_LABELS) * len(slides)))) as ex:
+        futures = {}
+        for i, slide_entry in enumerate(slides):
+            slide_prefix = slide_entry.path + os.sep
+            slide_cache = cache.get(slide_entry.name, {})
+            for label in _LABELS:
+                future = ex.submit(_count_cached, slide_prefix + label, slide_cache.get(label))
+                futures[future] = (i, slide_entry.name, label)
+
+        for future in as_completed(futures):
+            i, slide, label = futures[future]
+            counts = new_cache.setdefault(slide, {})
+            counts[label] = future.result()
+            if len(counts) < len(_LABELS):
+                continue
+
+            n_tumor = counts["tumor"][0]
+            n_other = counts["non_tumor"][0]
+            n_total = n_tumor + n_other
+            if n_total == 0:
+                print(f"{i}: empty slide, name: {slide}")
+                continue
+            frac = n_tumor / n_total * 100
+            print(f"{i}: {n_tumor}/{n_total}, {frac:.4f}% tumor tiles of total tiles, name: {slide}")
+            total_tumor += n_tumor
+            total_tiles += n_total
+    frac = total_tumor / total_tiles * 100 if total_tiles else 0.0
     print(f"Total: {total_tumor}/{total_tiles}, {frac:.4f}% tumor tiles of total tiles")
 
+    if use_cache:
+        save_cache(tile_path, new_cache)
+
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--config_path", default=script_dir + "/resources/config.json")
+    parser.add_argument("--max_workers", type=int, default=32)
+    parser.add_argument("--no_cache", action="store_true", help="Recount all slides and do not write tile count cache")
     args = parser.parse_args()
 
-    main(args.config_path)
+    main(args.config_path, max_workers=args.max_workers, use_cache=not args.no_cache)
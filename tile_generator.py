@@ -1,25 +1,156 @@
 # System
+import collections
+import functools
 import json
 import multiprocessing
+import operator
 import os
-import shutil
+import threading
 import xml.etree.ElementTree as ET
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # Libraries
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
 import openslide
 import pandas as pd
-from PIL import Image
 from tqdm import tqdm
 
 # Custom
 import tissue_detection
 
 _MULTIPROCESS = True
+_IO_WORKERS = 4
+_MAX_PENDING_PATCHES = 16 * _IO_WORKERS
+_TILE_WORKERS = 4
+_TILE_PREFETCH = 2 * _TILE_WORKERS  # Tiles read ahead of the patch loop
+_THUMBNAIL_SIZE = 2048  # Longest side of thumbnail.png and mask_img.png
+_TISSUE_MEDIAN_KERNEL = 11  # Median filter size in tissue detection, used by older configs without the key
+
+_LABEL_OPERATORS = {"==": operator.eq, ">=": operator.ge, ">": operator.gt, "<=": operator.le, "<": operator.lt}
+
+_WORKER_HANDLER = None  # WSIHandler of a pool worker, set by _init_worker
+
+
+# Every slide has its own worker process, keep OpenCV from starting a thread pool per process on top of that.
+# The handler is handed over once per worker instead of being pickled along with every slide
+def _init_worker(handler):
+    global _WORKER_HANDLER
+    _WORKER_HANDLER = handler
+    cv2.setNumThreads(1)
+
+
+def _worker_process_slide(slide_p):
+    return _WORKER_HANDLER.process_slide(slide_p)
+
+
+# Zero pad a mask to a multiple of tile_size and view it as (rows, tile_size, cols, tile_size) blocks
+def _tile_blocks(mask, tile_size, rows, cols):
+    padded = np.pad(
+        mask != 0, ((0, rows * tile_size - mask.shape[0]), (0, cols * tile_size - mask.shape[1])), mode="constant"
+    )
+    return padded.reshape(rows, tile_size, cols, tile_size)
+
+
+# Sum of the w x h region at (x, y) from an integral image as returned by cv2.integral
+def _region_sum(integral, x, y, w, h):
+    return int(integral[y + h, x + w] - integral[y, x + w] - integral[y + h, x] + integral[y, x])
+
+
+# Integral image of the annotation mask of a size x size tile at (x, y), None if no polygon reaches into the tile
+def _tile_annotation_integral(polygons, polygon_bounds, x, y, size):
+    # Bounds are widened by a pixel as the int32 cast of the shifted vertices truncates towards the tile
+    hits = np.flatnonzero(
+        (polygon_bounds[:, 0] < x + size + 1)
+        & (polygon_bounds[:, 2] > x - 1)
+        & (polygon_bounds[:, 1] < y + size + 1)
+        & (polygon_bounds[:, 3] > y - 1)
+    )
+    if len(hits) == 0:
+        return None
+
+    # One fillPoly call per polygon keeps overlapping polygons filled
+    tile_offset = np.array([x, y])
+    mask = np.zeros(shape=(size, size), dtype=np.uint8)
+    for i in hits:
+        cv2.fillPoly(mask, [(polygons[i] - tile_offset).astype(np.int32)], 1)
+
+    # Annotated pixels per patch become four lookups instead of a count over the patch
+    return cv2.integral(mask)
+
+
+# Slide name without the case_id that TCGA file names carry after the first dot
+def _slide_name(slide_path):
+    slide_name = slide_path.stem
+    if "TCGA" in str(slide_path):  # Remove case_id from slide_name
+        slide_name = slide_name.split(".")[0]
+    return slide_name
+
+
+# The slideinfo .csv file as DataFrame of strings, the optional Addition column is appended to the Pseudonym.
+# Read with pandas such that its NA tokens ("NA", "nan", empty, ...) are missing values and not literal strings
+def _read_slideinfo(slideinfo_file):
+    slide_df = pd.read_csv(slideinfo_file, dtype=str)
+    if "Addition" in slide_df.columns:
+        slide_df["Pseudonym"] = slide_df["Pseudonym"] + slide_df["Addition"].fillna("")
+    return slide_df
+
+
+# Number of entries in a directory without building the list of names
+def _count_dir(path):
+    with os.scandir(path) as it:
+        return sum(1 for _ in it)
+
+
+# Encode in one go and write with a single call instead of one write per JSON token, readers never see a partial file
+def _write_json(obj, file):
+    with open(file + ".tmp", "w") as json_file:
+        json_file.write(json.dumps(obj, indent=4))
+    os.replace(file + ".tmp", file)
+
+
+# Encode with OpenCV (expects BGR), used from the patch writer threads
+def _encode_image(img, output_format):
+    params = [cv2.IMWRITE_JPEG_QUALITY, 75] if output_format in ("jpeg", "jpg") else []  # Same quality as PIL
+    success, buffer = cv2.imencode("." + output_format, cv2.cvtColor(img, cv2.COLOR_RGB2BGR), params)
+    assert success, "Could not encode patch as " + output_format
+    return buffer
+
+
+def _save_image(img, file_name, output_format):
+    buffer = _encode_image(img, output_format)
+    with open(file_name, "wb") as image_file:
+        image_file.write(buffer)
+
+
+# ZipFile is not thread safe, only the encoding runs in parallel
+def _save_image_to_zip(img, zip_file, zip_lock, file_name, output_format):
+    buffer = _encode_image(img, output_format)
+    with zip_lock:
+        zip_file.writestr(file_name, buffer.tobytes())
+
+
+# Patch offsets along one tile axis, the last patch is shifted back to end at the tile border.
+# Tiles of a slide share their size, so the offsets are computed once and reused for every tile.
+@functools.lru_cache(maxsize=None)
+def _patch_offsets(tile_size, patch_size, px_overlap):
+    step = patch_size - px_overlap
+    offsets = []
+    for offset in range(0, tile_size, step):
+        if offset + patch_size >= tile_size:
+            offsets.append(tile_size - patch_size)
+            break
+        offsets.append(offset)
+    return tuple(offsets)
+
+
+# Resolve the comparison types of the label_dict once, check_for_label then runs without string compares
+def _label_rules(label_dict):
+    return [
+        (label, _LABEL_OPERATORS[label_dict[label]["type"]], label_dict[label]["threshold"]) for label in label_dict
+    ]
 
 
 class WSIHandler:
@@ -30,44 +161,58 @@ class WSIHandler:
         assert 1 >= config["tissue_coverage"] >= 0, "Tissue coverage must be between 1 and 0"
         assert config["blocked_threads"] >= 0
         assert config["patches_per_tile"] >= 1, "Patches per tile must be >= 1"
+        # Optional key, older configs keep the kernel size their datasets were generated with
+        tissue_median_kernel = config.get("tissue_median_kernel", _TISSUE_MEDIAN_KERNEL)
+        assert (
+            isinstance(tissue_median_kernel, int) and tissue_median_kernel >= 3 and tissue_median_kernel % 2 == 1
+        ), "Tissue median kernel must be an odd integer >= 3"
         assert 0 <= config["overlap"] < 1, "Overlap must be between 1 and 0"
         assert config["annotation_overlap"] >= 0 and config["overlap"] < 1, "Annotation overlap must be between 1 and 0"
+        for label in config["label_dict"]:
+            assert config["label_dict"][label]["type"] in _LABEL_OPERATORS, (
+                "Unknown label type " + config["label_dict"][label]["type"]
+            )
 
         self.slide = None
         self.output_path = None
         self.total_width = 0
         self.total_height = 0
         self.levels = 0
+        self.level_dimensions = None
+        self.level_downsamples = None
         self.current_level = 0
         self.annotation_list = None
         self.annotation_dict = None
         self.config = config
+        self.tissue_median_kernel = tissue_median_kernel
         self.annotated_only = self.config["save_annotated_only"]
         self.scanner = None
+        self.zip_files = {}
 
         self.res_x = None
         self.res_y = None
 
     def check_resolution(self, slide_path: str, res_range=[0.22, 0.27]):
+        # A local handle instead of self.slide, slides are checked from several threads at once
         try:
-            self.slide = openslide.OpenSlide(slide_path)
+            slide = openslide.OpenSlide(slide_path)
         except:
             print("Error when reading slide", slide_path)
             return False
 
+        # Only the slide properties are needed, close the handle right away instead of waiting for garbage collection
         try:
-            scanner, res_x, res_y = self.init_patch_calibration()
+            scanner, res_x, res_y = self.init_patch_calibration(slide.properties)
         except:
-            del self.slide
             return False
+        finally:
+            slide.close()
 
         mpp = (res_x + res_y) / 2
 
         if mpp < min(res_range) or mpp > max(res_range):
-            del self.slide
             return False
 
-        del self.slide
         return True
 
     def load_slide(self, slide_path: str):
@@ -75,6 +220,9 @@ class WSIHandler:
         self.total_width = self.slide.dimensions[0]
         self.total_height = self.slide.dimensions[1]
         self.levels = self.slide.level_count - 1
+        # OpenSlide queries the library for every level on each access of these properties, look them up once per slide
+        self.level_dimensions = self.slide.level_dimensions
+        self.level_downsamples = self.slide.level_downsamples
 
         processing_level = self.config["processing_level"]
 
@@ -102,61 +250,85 @@ class WSIHandler:
             with open(annotation_path) as annotation_file:
                 annotations = json.load(annotation_file)
             # Only working for features of the type polygon
-            for polygon_nb in range(len(annotations["features"])):
-                annotation_dict.update({polygon_nb: annotations["features"][polygon_nb]["geometry"]["coordinates"][0]})
+            for polygon_nb, feature in enumerate(annotations["features"]):
+                annotation_dict[polygon_nb] = np.array(feature["geometry"]["coordinates"][0], dtype=np.float64)
 
         # xml for CAMELYON17
         elif file_format == ".xml":
             tree = ET.parse(annotation_path)
             root = tree.getroot()
 
+            polygon_nb = 0
             for elem in root:
-                polygon_nb = 0
                 for subelem in elem:
-                    items = subelem.attrib
-                    if "Type" in items.keys():
-                        if items["Type"] == "Polygon":
-                            annotation_dict.update({polygon_nb: None})
-                            polygon_list = []
-                            for coordinates in subelem:
-                                for coord in coordinates:
-                                    polygon_list.append([float(coord.attrib["X"]), float(coord.attrib["Y"])])
-                            annotation_dict[polygon_nb] = polygon_list
-                            polygon_nb += 1
+                    if subelem.get("Type") == "Polygon":
+                        # NumPy parses the coordinate strings in C, no float() call per value
+                        annotation_dict[polygon_nb] = np.array(
+                            [[coord.get("X"), coord.get("Y")] for coordinates in subelem for coord in coordinates],
+                            dtype=np.float64,
+                        )
+                        polygon_nb += 1
         else:
             return None
 
         return annotation_dict
 
+    def read_region_rgb(self, location, level, size):
+        # Drop alpha before converting to NumPy, gives a contiguous (read-only) RGB array without the RGBA copy
+        return np.asarray(self.slide.read_region(location, level, size).convert("RGB"))
+
+    def prefetch_tiles(self, regions, level=0):
+        # Reads (x, y, size) regions on a few threads and yields them in order, x and y are level 0 coordinates as for
+        # read_region. read_region releases the GIL, so the next tiles are decoded while the caller works on the
+        # current one
+        tile_pool = ThreadPoolExecutor(max_workers=_TILE_WORKERS)
+        tile_futures = collections.deque()
+        try:
+            for x, y, size in regions:
+                tile_futures.append(tile_pool.submit(self.read_region_rgb, (x, y), level, (size, size)))
+                if len(tile_futures) > _TILE_PREFETCH:
+                    yield tile_futures.popleft().result()
+            while tile_futures:
+                yield tile_futures.popleft().result()
+        finally:
+            tile_pool.shutdown(wait=True, cancel_futures=True)
+
     def get_img(self, level=None, show=False):
         if level is None:
             level = self.levels
 
-        dims = self.slide.level_dimensions[level]
-        image = np.array(self.slide.read_region((0, 0), level, dims))
+        dims = self.level_dimensions[level]
+        # Writable RGB copy, tissue detection modifies the image in place
+        image = self.read_region_rgb((0, 0), level, dims).copy()
 
         if show:
+            import matplotlib.pyplot as plt
+
             plt.imshow(image)
             plt.title("Slide image")
             plt.show()
 
         return image, level
 
-    def apply_tissue_detection(self, level=None, show=False, remove_top_border=False):
+    def apply_tissue_detection(
+        self, level=None, show=False, remove_top_border=False, median_kernel_size=_TISSUE_MEDIAN_KERNEL
+    ):
         if level is not None:
             image, level = self.get_img(level, show)
         else:
             image, level = self.get_img(show=show)
 
-        tissue_mask = tissue_detection.tissue_detection(image, remove_top_border)
-
-        mask_img = cv2.cvtColor(image, cv2.COLOR_RGBA2RGB)  # Remove alpha channel
-        contours, _ = cv2.findContours(tissue_mask, mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_SIMPLE)
-        cv2.drawContours(mask_img, contours, -1, (0, 255, 0), 3)
+        tissue_mask = tissue_detection.tissue_detection(image, remove_top_border, median_kernel_size)
 
         # result = cv2.bitwise_and(image, image, mask=tissue_mask)
 
         if show:
+            import matplotlib.pyplot as plt
+
+            mask_img = image.copy()
+            contours, _ = cv2.findContours(tissue_mask, mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_SIMPLE)
+            cv2.drawContours(mask_img, contours, -1, (0, 255, 0), 3)
+
             plt.imshow(mask_img)
             plt.title("Tissue Mask")
             plt.show()
@@ -171,7 +343,7 @@ class WSIHandler:
         else:
             tile_size_0 = self.config["patches_per_tile"] * self.config["patch_size"]
 
-        downscale_factor = int(self.slide.level_downsamples[level])
+        downscale_factor = int(self.level_downsamples[level])
         tile_size = int(tile_size_0 / downscale_factor)
 
         assert self.config["patches_per_tile"] >= 1, "Patches per tile must be greater than 1."
@@ -187,122 +359,130 @@ class WSIHandler:
         if col_residue:
             cols += 1
 
-        if self.config["use_tissue_detection"]:
+        # The tiled preview is only drawn when it is shown
+        draw_tiles = show and self.config["use_tissue_detection"]
+        if draw_tiles:
             colored = cv2.cvtColor(tissue_mask, cv2.COLOR_GRAY2RGB)
 
-        if self.annotation_dict is not None:
-            annotation_mask = np.zeros(shape=(tissue_mask.shape[0], tissue_mask.shape[1]))
-            scaling_factor = self.slide.level_downsamples[level]
-            scaled_list = [
-                [[point[0] / scaling_factor, point[1] / scaling_factor] for point in self.annotation_dict[polygon]]
-                for polygon in self.annotation_dict
-            ]
+        if self.config["use_tissue_detection"]:
+            # Per tile pixel counts in one pass, border tiles are smaller and therefore padded
+            tissue_pixels = _tile_blocks(tissue_mask, tile_size, rows, cols).sum(axis=(1, 3))
+            tile_heights = np.minimum(tile_size, tissue_mask.shape[0] - np.arange(rows) * tile_size)
+            tile_widths = np.minimum(tile_size, tissue_mask.shape[1] - np.arange(cols) * tile_size)
+            tissue_coverage = tissue_pixels / np.outer(tile_heights, tile_widths)
+        else:
+            # Without tissue detection the mask is all ones, every tile is fully covered
+            tissue_coverage = np.ones(shape=(rows, cols))
 
-            for polygon in scaled_list:
-                cv2.fillPoly(annotation_mask, [np.array(polygon).astype(np.int32)], 1)
+        annotated_tiles = np.zeros(shape=(rows, cols), dtype=bool)
+        if self.annotation_dict is not None:
+            scaling_factor = self.level_downsamples[level]
+            for polygon in self.annotation_dict:
+                scaled_polygon = np.asarray(self.annotation_dict[polygon], dtype=np.float64) / scaling_factor
+                points = scaled_polygon.astype(np.int32)
+
+                # Rasterize each polygon only over the tiles its bounding box touches instead of a whole level mask
+                (x_min, y_min), (x_max, y_max) = points.min(axis=0), points.max(axis=0)
+                row_min, col_min = max(y_min // tile_size, 0), max(x_min // tile_size, 0)
+                row_max, col_max = min(y_max // tile_size + 1, rows), min(x_max // tile_size + 1, cols)
+                if row_min >= row_max or col_min >= col_max:
+                    continue
+
+                local_mask = np.zeros(
+                    shape=(
+                        min(row_max * tile_size, tissue_mask.shape[0]) - row_min * tile_size,
+                        min(col_max * tile_size, tissue_mask.shape[1]) - col_min * tile_size,
+                    ),
+                    dtype=np.uint8,
+                )
+                offset = np.array([col_min * tile_size, row_min * tile_size], dtype=np.int32)
+                cv2.fillPoly(local_mask, [points - offset], 1)
+
+                local_tiles = _tile_blocks(local_mask, tile_size, row_max - row_min, col_max - col_min)
+                annotated_tiles[row_min:row_max, col_min:col_max] |= local_tiles.any(axis=(1, 3))
 
         relevant_tiles_dict = {}
         tile_nb = 0
 
-        # +1 to solve border issues
-        for row in range(rows):
-            for col in range(cols):
-                tile = tissue_mask[
-                    row * tile_size : row * tile_size + tile_size, col * tile_size : col * tile_size + tile_size
-                ]
-                tissue_coverage = np.count_nonzero(tile) / tile.size
-                annotated = False
-
-                if self.annotation_dict is not None:
-                    if (
-                        np.count_nonzero(
-                            annotation_mask[
-                                row * tile_size : row * tile_size + tile_size,
-                                col * tile_size : col * tile_size + tile_size,
-                            ]
-                        )
-                        > 0
-                    ):
-                        annotated = True
-
-                if tissue_coverage >= min_coverage or annotated:
-                    relevant_tiles_dict.update(
-                        {
-                            tile_nb: {
-                                "x": col * tile_size,
-                                "y": row * tile_size,
-                                "size": tile_size,
-                                "level": level,
-                                "annotated": annotated,
-                            }
-                        }
-                    )
-                    if self.config["use_tissue_detection"]:
-                        if annotated:
-                            colored = cv2.rectangle(
-                                colored,
-                                (col * tile_size, row * tile_size),
-                                (col * tile_size + tile_size, row * tile_size + tile_size),
-                                (0, 255, 0),
-                                3,
-                            )
-                        else:
-                            colored = cv2.rectangle(
-                                colored,
-                                (col * tile_size, row * tile_size),
-                                (col * tile_size + tile_size, row * tile_size + tile_size),
-                                (255, 0, 0),
-                                1,
-                            )
+        for row, col in np.argwhere((tissue_coverage >= min_coverage) | annotated_tiles):
+            row, col = int(row), int(col)
+            annotated = bool(annotated_tiles[row, col])
+
+            relevant_tiles_dict[tile_nb] = {
+                "x": col * tile_size,
+                "y": row * tile_size,
+                "size": tile_size,
+                "level": level,
+                "annotated": annotated,
+            }
+            if draw_tiles:
+                # Drawn in place, annotated tiles in green, others in red
+                cv2.rectangle(
+                    colored,
+                    (col * tile_size, row * tile_size),
+                    (col * tile_size + tile_size, row * tile_size + tile_size),
+                    (0, 255, 0) if annotated else (255, 0, 0),
+                    3 if annotated else 1,
+                )
 
-                    tile_nb += 1
+            tile_nb += 1
+
+        if draw_tiles:
+            import matplotlib.pyplot as plt
 
-        if show and self.config["use_tissue_detection"]:
             plt.imshow(colored)
             plt.title("Tiled image")
             plt.show()
 
         return relevant_tiles_dict
 
-    def check_for_label(self, label_dict, annotation_mask):
-        label_percentage = np.count_nonzero(annotation_mask) / annotation_mask.size
-
-        for label in label_dict:
-            if label_dict[label]["type"] == "==":
-                if label_dict[label]["threshold"] == label_percentage:
-                    return label, label_percentage
-            elif label_dict[label]["type"] == ">=":
-                if label_percentage >= label_dict[label]["threshold"]:
-                    return label, label_percentage
-            elif label_dict[label]["type"] == ">":
-                if label_percentage > label_dict[label]["threshold"]:
-                    return label, label_percentage
-            elif label_dict[label]["type"] == "<=":
-                if label_percentage <= label_percentage[label]["threshold"]:
-                    return label, label_percentage
-            elif label_dict[label]["type"] == "<":
-                if label_percentage < label_dict[label]["threshold"]:
-                    return label, label_percentage
+    def check_for_label(self, label_rules, label_percentage):
+        for label, compare, threshold in label_rules:
+            if compare(label_percentage, threshold):
+                return label, label_percentage
 
         return None, None
 
-    def make_dirs(self, output_path, slide_name, label_dict, annotated):
+    def make_dirs(self, output_path, slide_name, label_dict, annotated, zip_patches=False):
         slide_path = os.path.join(output_path, slide_name)
         if not os.path.exists(slide_path):
             os.makedirs(slide_path)
 
-        if not annotated:
-            unlabeled_path = os.path.join(slide_path, "unlabeled")
-            if not os.path.exists(unlabeled_path):
-                os.makedirs(unlabeled_path)
-        else:
-            for label in label_dict:
+        labels = ["unlabeled"] if not annotated else list(label_dict)
+
+        # Patches are streamed into one zip per label instead of a directory per label. The patches are already
+        # compressed images, so they are stored as they are instead of deflating them a second time
+        self.zip_files = {}
+        for label in labels:
+            if zip_patches:
+                zip_file = zipfile.ZipFile(
+                    os.path.join(slide_path, label + ".zip"), mode="w", compression=zipfile.ZIP_STORED
+                )
+                self.zip_files[label] = (zip_file, threading.Lock())
+            else:
                 sub_path = os.path.join(slide_path, label)
                 if not os.path.exists(sub_path):
                     os.makedirs(sub_path)
 
         self.output_path = slide_path
 
+    def submit_patch(self, io_pool, io_futures, patch, label, file_name, output_format):
+        if label in self.zip_files:
+            zip_file, zip_lock = self.zip_files[label]
+            io_futures.append(io_pool.submit(_save_image_to_zip, patch, zip_file, zip_lock, file_name, output_format))
+        else:
+            file_name = os.path.join(self.output_path, label, file_name)
+            io_futures.append(io_pool.submit(_save_image, patch, file_name, output_format))
+
+        # Pending patches keep their tile alive, wait for the oldest writes when the writers fall behind
+        while len(io_futures) > _MAX_PENDING_PATCHES:
+            io_futures.popleft().result()
+
+    def close_zip_files(self):
+        for zip_file, _ in self.zip_files.values():
+            zip_file.close()
+        self.zip_files = {}
+
     def extract_calibrated_patches(
         self,
         tile_dict,
@@ -316,131 +496,149 @@ class WSIHandler:
         save_patches=False,
         zip_patches=False,
     ):
-        scaling_factor = int(self.slide.level_downsamples[level])
+        scaling_factor = int(self.level_downsamples[level])
+
+        # Same for every tile, look up once instead of per tile or patch
+        patch_size_microns = self.config["calibration"]["patch_size_microns"]
+        patch_size_px_x = int(np.round(patch_size_microns / self.res_x))
+        patch_size_px_y = int(np.round(patch_size_microns / self.res_y))
+        resize = self.config["calibration"]["resize"]
+        resize_size = (self.config["patch_size"], self.config["patch_size"])
+        annotated_only = self.annotated_only
+
+        # Patches that are resized anyway are cut from the coarsest pyramid level that still has the output
+        # resolution, which decodes a fraction of the level 0 pixels. Positions stay in level 0 coordinates
+        read_level = 0
+        if resize:
+            read_level = self.slide.get_best_level_for_downsample(
+                min(patch_size_px_x, patch_size_px_y) / self.config["patch_size"]
+            )
+        read_downsample = self.level_downsamples[read_level] if read_level > 0 else 1
+        read_patch_size_x = int(round(patch_size_px_x / read_downsample))
+        read_patch_size_y = int(round(patch_size_px_y / read_downsample))
+
+        # Polygons are float64 arrays from load_annotation (no copy), label rules are resolved once per slide
+        if annotations is not None:
+            polygons = [np.asarray(annotations[polygon], dtype=np.float64) for polygon in annotations]
+            polygon_bounds = np.array([[*p.min(axis=0), *p.max(axis=0)] for p in polygons]).reshape(-1, 4)
+            label_rules = _label_rules(label_dict)
+            annotated_labels = {
+                label for label in self.config["label_dict"] if self.config["label_dict"][label]["annotated"]
+            }
+
+        # Patches are encoded and written in the background while the next patches are cut
+        io_pool = ThreadPoolExecutor(max_workers=_IO_WORKERS)
+        io_futures = collections.deque()
+
+        # Tiles are read ahead on a few threads while the patches of the current tile are cut
+        if save_patches:
+            tiles = self.prefetch_tiles(
+                (
+                    (
+                        tile_dict[tile_key]["x"] * scaling_factor,
+                        tile_dict[tile_key]["y"] * scaling_factor,
+                        int(np.ceil(tile_dict[tile_key]["size"] * scaling_factor / read_downsample)),
+                    )
+                    for tile_key in tile_dict
+                ),
+                level=read_level,
+            )
 
         patch_dict = {}
         patch_nb = 0
-        for tile_key in tile_dict:
-            tile_x = tile_dict[tile_key]["x"] * scaling_factor
-            tile_y = tile_dict[tile_key]["y"] * scaling_factor
-
-            tile_size_px = tile_dict[tile_key]["size"] * scaling_factor
-
-            patch_size_px_x = int(np.round(self.config["calibration"]["patch_size_microns"] / self.res_x))
-            patch_size_px_y = int(np.round(self.config["calibration"]["patch_size_microns"] / self.res_y))
-
-            if save_patches:
-                tile = np.array(self.slide.read_region((tile_x, tile_y), level=0, size=(tile_size_px, tile_size_px)))
-                tile = tile[:, :, 0:3]
-
-            if tile_dict[tile_key]["annotated"]:
-                px_overlap_x = int(patch_size_px_x * annotation_overlap)
-                px_overlap_y = int(patch_size_px_y * annotation_overlap)
-
-            else:
-                px_overlap_x = int(patch_size_px_x * overlap)
-                px_overlap_y = int(patch_size_px_y * overlap)
-
-            rows = int(np.ceil(tile_size_px / (patch_size_px_y - px_overlap_y)))
-            cols = int(np.ceil(tile_size_px / (patch_size_px_x - px_overlap_x)))
+        try:
+            for tile_key in tile_dict:
+                tile_x = tile_dict[tile_key]["x"] * scaling_factor
+                tile_y = tile_dict[tile_key]["y"] * scaling_factor
 
-            # create annotation mask
-            if annotations is not None:
-                # Translate from world coordinates to tile coordinates
-                tile_annotation_list = [
-                    [[point[0] - tile_x, point[1] - tile_y] for point in annotations[polygon]]
-                    for polygon in annotations
-                ]
+                tile_size_px = tile_dict[tile_key]["size"] * scaling_factor
 
-                # Create mask from polygons
-                tile_annotation_mask = np.zeros(shape=(tile_size_px, tile_size_px))
+                if save_patches:
+                    tile = next(tiles)
 
-                for polygon in tile_annotation_list:
-                    cv2.fillPoly(tile_annotation_mask, [np.array(polygon).astype(np.int32)], 1)
+                if tile_dict[tile_key]["annotated"]:
+                    px_overlap_x = int(patch_size_px_x * annotation_overlap)
+                    px_overlap_y = int(patch_size_px_y * annotation_overlap)
 
-            stop_y = False
+                else:
+                    px_overlap_x = int(patch_size_px_x * overlap)
+                    px_overlap_y = int(patch_size_px_y * overlap)
 
-            for row in range(rows):
-                stop_x = False
+                patch_offsets_y = _patch_offsets(tile_size_px, patch_size_px_y, px_overlap_y)
+                patch_offsets_x = _patch_offsets(tile_size_px, patch_size_px_x, px_overlap_x)
 
-                for col in range(cols):
-                    # Calculate patch coordinates
-                    patch_x = int(col * (patch_size_px_x - px_overlap_x))
-                    patch_y = int(row * (patch_size_px_y - px_overlap_y))
+                # create annotation mask
+                if annotations is not None:
+                    # Tiles no polygon reaches into have no annotated pixels, skip rasterizing their mask
+                    tile_annotation_integral = _tile_annotation_integral(
+                        polygons, polygon_bounds, tile_x, tile_y, tile_size_px
+                    )
 
-                    if patch_y + patch_size_px_y >= tile_size_px:
-                        stop_y = True
-                        patch_y = tile_size_px - patch_size_px_y
+                for patch_y in patch_offsets_y:
+                    for patch_x in patch_offsets_x:
+                        global_x = patch_x + tile_x
+                        global_y = patch_y + tile_y
 
-                    if patch_x + patch_size_px_x >= tile_size_px:
-                        stop_x = True
-                        patch_x = tile_size_px - patch_size_px_x
+                        if save_patches:
+                            read_x = int(round(patch_x / read_downsample))
+                            read_y = int(round(patch_y / read_downsample))
+                            patch = tile[read_y : read_y + read_patch_size_y, read_x : read_x + read_patch_size_x, :]
 
-                    global_x = patch_x + tile_x
-                    global_y = patch_y + tile_y
+                            if not patch.any():  # Skip black borders, cheaper than summing the patch
+                                break
 
-                    if save_patches:
-                        patch = tile[patch_y : patch_y + patch_size_px_y, patch_x : patch_x + patch_size_px_x, :]
+                        # check if the patch is annotated
+                        annotated = False
+                        if annotations is not None:
+                            if tile_annotation_integral is None:
+                                annotated_px = 0
+                            else:
+                                annotated_px = _region_sum(
+                                    tile_annotation_integral, patch_x, patch_y, patch_size_px_x, patch_size_px_y
+                                )
+                            label, label_percentage = self.check_for_label(
+                                label_rules, annotated_px / (patch_size_px_x * patch_size_px_y)
+                            )
+                            annotated = label in annotated_labels
 
-                        if np.sum(patch) == 0:
-                            break
+                        else:
+                            label = "unlabeled"
 
-                    # check if the patch is annotated
-                    annotated = False
-                    if annotations is not None:
-                        patch_mask = tile_annotation_mask[
-                            patch_y : patch_y + patch_size_px_y, patch_x : patch_x + patch_size_px_x
-                        ]
-                        label = self.check_for_label(label_dict, patch_mask)
                         if label is not None:
-                            if self.config["label_dict"][label]["annotated"]:
-                                annotated = True
+                            if annotated_only and annotated or not annotated_only:
+                                file_name = slide_name + "_" + str(global_x) + "_" + str(global_y) + "." + output_format
 
-                    else:
-                        label = "unlabeled"
+                                if save_patches:
+                                    if resize:
+                                        patch = cv2.resize(patch, resize_size)
 
-                    if label is not None:
-                        if self.annotated_only and annotated or not self.annotated_only:
-                            file_name = slide_name + "_" + str(global_x) + "_" + str(global_y) + "." + output_format
+                                    self.submit_patch(io_pool, io_futures, patch, label, file_name, output_format)
 
-                            if save_patches:
-                                if self.config["calibration"]["resize"]:
-                                    patch = cv2.resize(patch, (self.config["patch_size"], self.config["patch_size"]))
-
-                                patch = Image.fromarray(patch)
-                                patch.save(os.path.join(self.output_path, label, file_name), format=output_format)
-
-                                # Too slow to append patches directly to zip directory
-                                # if zip_patches:
-                                #     img_buffer = io.BytesIO()
-                                #     patch.save(img_buffer, format=output_format)
-                                #     img_buffer.seek(0)
-                                #     with zipfile.ZipFile(os.path.join(self.output_path, label + ".zip"), mode="a") as zip_file:
-                                #         zip_file.writestr(file_name, img_buffer.read())
-                                # else:
-                                #     patch.save(os.path.join(self.output_path, label, file_name), format=output_format)
-
-                            patch_dict.update(
-                                {
-                                    patch_nb: {
-                                        "slide_name": slide_name,
-                                        "patch_path": os.path.join(label + ".zip", file_name)
-                                        if zip_patches
-                                        else os.path.join(label, file_name),
-                                        "label": label,
-                                        "x_pos": global_x,
-                                        "y_pos": global_y,
-                                        "patch_size_x": patch_size_px_x,
-                                        "patch_size_y": patch_size_px_y,
-                                        "resized": self.config["calibration"]["resize"],
-                                    }
+                                patch_dict[patch_nb] = {
+                                    "slide_name": slide_name,
+                                    "patch_path": os.path.join(label + ".zip", file_name)
+                                    if zip_patches
+                                    else os.path.join(label, file_name),
+                                    "label": label,
+                                    "x_pos": global_x,
+                                    "y_pos": global_y,
+                                    "patch_size_x": patch_size_px_x,
+                                    "patch_size_y": patch_size_px_y,
+                                    "resized": resize,
                                 }
-                            )
-                            patch_nb += 1
-                    if stop_x:
-                        break
-                if stop_y:
-                    break
+                                patch_nb += 1
+        except BaseException:
+            # Drop the queued patches, the running writes finish before the zip files are closed by the caller
+            io_pool.shutdown(wait=True, cancel_futures=True)
+            raise
+        finally:
+            if save_patches:
+                tiles.close()
+
+        # Wait for the writer threads and raise their errors
+        io_pool.shutdown(wait=True)
+        for future in io_futures:
+            future.result()
 
         return patch_dict
 
@@ -462,160 +660,166 @@ class WSIHandler:
         px_overlap = int(patch_size * overlap)
         patch_dict = {}
 
-        scaling_factor = int(self.slide.level_downsamples[level])
+        scaling_factor = int(self.level_downsamples[level])
         patch_nb = 0
 
-        for tile_key in tile_dict:
-            # skip unannotated tiles in case only annotated patches should be saved
-            if self.annotated_only and not tile_dict[tile_key]["annotated"]:
-                pass
-            else:
-                # TODO: rows and cols aren't calculated correctly, instead a quick fix by using breaks was applied
-
-                tile_x = tile_dict[tile_key]["x"] * scaling_factor
-                tile_y = tile_dict[tile_key]["y"] * scaling_factor
-                tile_size = tile_dict[tile_key]["size"] * scaling_factor
+        # Same for every tile, look up once instead of per tile or patch
+        px_overlap_annotated = int(patch_size * annotation_overlap)
+        px_overlap_unannotated = int(patch_size * overlap)
+        annotated_only = self.annotated_only
+
+        # Polygons are float64 arrays from load_annotation (no copy), label rules are resolved once per slide
+        if annotations is not None:
+            polygons = [np.asarray(annotations[polygon], dtype=np.float64) for polygon in annotations]
+            polygon_bounds = np.array([[*p.min(axis=0), *p.max(axis=0)] for p in polygons]).reshape(-1, 4)
+            label_rules = _label_rules(label_dict)
+            annotated_labels = {
+                label for label in self.config["label_dict"] if self.config["label_dict"][label]["annotated"]
+            }
 
-                if save_patches:
-                    tile = np.array(self.slide.read_region((tile_x, tile_y), level=0, size=(tile_size, tile_size)))
-                    tile = tile[:, :, 0:3]
+        # Patches are encoded and written in the background while the next patches are cut
+        io_pool = ThreadPoolExecutor(max_workers=_IO_WORKERS)
+        io_futures = collections.deque()
 
-                # overlap separately  for annotated and unannotated patches
-                if tile_dict[tile_key]["annotated"]:
-                    px_overlap = int(patch_size * annotation_overlap)
-                    rows = int(np.ceil((tile_size) / (patch_size - px_overlap)))
-                    cols = int(np.ceil((tile_size) / (patch_size - px_overlap)))
+        # Tiles are read ahead on a few threads while the patches of the current tile are cut
+        if save_patches:
+            tiles = self.prefetch_tiles(
+                [tile_dict[tile_key][key] * scaling_factor for key in ("x", "y", "size")]
+                for tile_key in tile_dict
+                if not (annotated_only and not tile_dict[tile_key]["annotated"])
+            )
 
+        try:
+            for tile_key in tile_dict:
+                # skip unannotated tiles in case only annotated patches should be saved
+                if annotated_only and not tile_dict[tile_key]["annotated"]:
+                    pass
                 else:
-                    px_overlap = int(patch_size * overlap)
-                    rows = int(np.ceil((tile_size) / (patch_size - px_overlap)))
-                    cols = int(np.ceil((tile_size) / (patch_size - px_overlap)))
-
-                # create annotation mask
-                if annotations is not None:
-                    # Translate from world coordinates to tile coordinates
-                    tile_annotation_list = [
-                        [[point[0] - tile_x, point[1] - tile_y] for point in annotations[polygon]]
-                        for polygon in annotations
-                    ]
-
-                    # Create mask from polygons
-                    tile_annotation_mask = np.zeros(shape=(tile_size, tile_size))
-
-                    for polygon in tile_annotation_list:
-                        cv2.fillPoly(tile_annotation_mask, [np.array(polygon).astype(np.int32)], 1)
-
-                stop_y = False
-
-                for row in range(rows):
-                    stop_x = False
+                    tile_x = tile_dict[tile_key]["x"] * scaling_factor
+                    tile_y = tile_dict[tile_key]["y"] * scaling_factor
+                    tile_size = tile_dict[tile_key]["size"] * scaling_factor
 
-                    for col in range(cols):
-                        # Calculate patch coordinates
-                        patch_x = int(col * (patch_size - px_overlap))
-                        patch_y = int(row * (patch_size - px_overlap))
-
-                        if patch_y + patch_size >= tile_size:
-                            stop_y = True
-                            patch_y = tile_size - patch_size
-
-                        if patch_x + patch_size >= tile_size:
-                            stop_x = True
-                            patch_x = tile_size - patch_size
+                    if save_patches:
+                        tile = next(tiles)
 
-                        global_x = patch_x + tile_x
-                        global_y = patch_y + tile_y
+                    # overlap separately  for annotated and unannotated patches
+                    if tile_dict[tile_key]["annotated"]:
+                        px_overlap = px_overlap_annotated
+                    else:
+                        px_overlap = px_overlap_unannotated
+                    patch_offsets = _patch_offsets(tile_size, patch_size, px_overlap)
 
-                        if save_patches:
-                            patch = tile[patch_y : patch_y + patch_size, patch_x : patch_x + patch_size, :]
+                    # create annotation mask
+                    if annotations is not None:
+                        # Tiles no polygon reaches into have no annotated pixels, skip rasterizing their mask
+                        tile_annotation_integral = _tile_annotation_integral(
+                            polygons, polygon_bounds, tile_x, tile_y, tile_size
+                        )
 
-                            if np.sum(patch) == 0:
-                                break
+                    for patch_y in patch_offsets:
+                        for patch_x in patch_offsets:
+                            global_x = patch_x + tile_x
+                            global_y = patch_y + tile_y
 
-                        # check if the patch is annotated
-                        annotated = False
-                        if annotations is not None:
-                            patch_mask = tile_annotation_mask[
-                                patch_y : patch_y + patch_size, patch_x : patch_x + patch_size
-                            ]
-                            label, label_percentage = self.check_for_label(label_dict, patch_mask)
-                            if label is not None:
-                                if self.config["label_dict"][label]["annotated"]:
-                                    annotated = True
+                            if save_patches:
+                                patch = tile[patch_y : patch_y + patch_size, patch_x : patch_x + patch_size, :]
 
-                        else:
-                            label = "unlabeled"
-                            label_percentage = None
+                                if not patch.any():  # Skip black borders, cheaper than summing the patch
+                                    break
 
-                        if label is not None:
-                            if self.annotated_only and annotated or not self.annotated_only:
-                                if slide_name is not None:
-                                    file_name = (
-                                        slide_name + "_" + str(global_x) + "_" + str(global_y) + "." + output_format
-                                    )
+                            # check if the patch is annotated
+                            annotated = False
+                            if annotations is not None:
+                                if tile_annotation_integral is None:
+                                    annotated_px = 0
                                 else:
-                                    file_name = (
-                                        str(patch_nb) + "_" + str(global_x) + "_" + str(global_y) + "." + output_format
+                                    annotated_px = _region_sum(
+                                        tile_annotation_integral, patch_x, patch_y, patch_size, patch_size
                                     )
+                                label, label_percentage = self.check_for_label(
+                                    label_rules, annotated_px / (patch_size * patch_size)
+                                )
+                                annotated = label in annotated_labels
 
-                                if save_patches:
-                                    patch = Image.fromarray(patch)
-                                    patch.save(os.path.join(self.output_path, label, file_name), format=output_format)
-
-                                patch_dict.update(
-                                    {
-                                        patch_nb: {
-                                            "slide_name": slide_name,
-                                            "patch_path": os.path.join(label + ".zip", file_name)
-                                            if zip_patches
-                                            else os.path.join(label, file_name),
-                                            "label": label,
-                                            "tumor_coverage": label_percentage,
-                                            "x_pos": global_x,
-                                            "y_pos": global_y,
-                                            "patch_size_x": patch_size,
-                                            "patch_size_y": patch_size,
-                                        }
+                            else:
+                                label = "unlabeled"
+                                label_percentage = None
+
+                            if label is not None:
+                                if annotated_only and annotated or not annotated_only:
+                                    if slide_name is not None:
+                                        file_name = (
+                                            slide_name + "_" + str(global_x) + "_" + str(global_y) + "." + output_format
+                                        )
+                                    else:
+                                        file_name = (
+                                            str(patch_nb)
+                                            + "_"
+                                            + str(global_x)
+                                            + "_"
+                                            + str(global_y)
+                                            + "."
+                                            + output_format
+                                        )
+
+                                    if save_patches:
+                                        self.submit_patch(io_pool, io_futures, patch, label, file_name, output_format)
+
+                                    patch_dict[patch_nb] = {
+                                        "slide_name": slide_name,
+                                        "patch_path": os.path.join(label + ".zip", file_name)
+                                        if zip_patches
+                                        else os.path.join(label, file_name),
+                                        "label": label,
+                                        "tumor_coverage": label_percentage,
+                                        "x_pos": global_x,
+                                        "y_pos": global_y,
+                                        "patch_size_x": patch_size,
+                                        "patch_size_y": patch_size,
                                     }
-                                )
-                                patch_nb += 1
-                        if stop_x:
-                            break
-                    if stop_y:
-                        break
+                                    patch_nb += 1
+        except BaseException:
+            # Drop the queued patches, the running writes finish before the zip files are closed by the caller
+            io_pool.shutdown(wait=True, cancel_futures=True)
+            raise
+        finally:
+            if save_patches:
+                tiles.close()
+
+        # Wait for the writer threads and raise their errors
+        io_pool.shutdown(wait=True)
+        for future in io_futures:
+            future.result()
 
         return patch_dict
 
-    def export_dict(self, dict, metadata_format, filename):
+    def export_dict(self, dict, metadata_format, filename, output_path=None):
+        # Defaults to the folder of the current slide
+        if output_path is None:
+            output_path = self.output_path
+
         if metadata_format == "json":
-            file = os.path.join(self.output_path, filename + ".json")
-            with open(file, "w") as json_file:
-                json.dump(dict, json_file, indent=4)
+            _write_json(dict, os.path.join(output_path, filename + ".json"))
         elif metadata_format == "csv":
             df = pd.DataFrame(dict.values())
-            file = os.path.join(self.output_path, filename + ".csv")
-            df.to_csv(file, index=False)
+            file = os.path.join(output_path, filename + ".csv")
+            df.to_csv(file + ".tmp", index=False)
+            os.replace(file + ".tmp", file)
         else:
             print("Could not write metadata. Metadata format has to be json or csv")
 
-    def zip_patch_directories(self):
-        patch_dirs = [f for f in os.listdir(self.output_path) if os.path.isdir(os.path.join(self.output_path, f))]
-        for dir in patch_dirs:
-            with zipfile.ZipFile(os.path.join(self.output_path, dir + ".zip"), mode="w") as zip_file:
-                for file_name in os.listdir(os.path.join(self.output_path, dir)):
-                    zip_file.write(os.path.join(self.output_path, dir, file_name), arcname=file_name)
-            shutil.rmtree(os.path.join(self.output_path, dir))
-
     def export_slide_info(self, slide_p: Path, slide_name: str, scaling_factor: int):
         if self.config["slideinfo_file"] is not None:
             slideinfo_file = Path(self.config["slideinfo_file"])
             assert slideinfo_file.is_file(), "Provided slideinfo .csv file does not exist"
-            slide_df = pd.read_csv(slideinfo_file, dtype=str)
-            if "Addition" in slide_df.columns:
-                slide_df["Pseudonym"] = slide_df["Pseudonym"] + slide_df["Addition"].fillna("")
+            slide_df = _read_slideinfo(slideinfo_file)
+            slide_labels = slide_df.loc[slide_df["Pseudonym"] == slide_name, "Label"].to_list()
+            assert len(slide_labels) == 1, (
+                "Slide " + slide_name + " has to be listed exactly once in the slideinfo file"
+            )
             dict = {
                 "slide_filename": slide_p.name,  # Use name instead of stem to include suffix
-                "slide_label": slide_df[slide_df["Pseudonym"] == slide_name]["Label"].item(),
+                "slide_label": slide_labels[0],
             }
         else:
             dict = {
@@ -628,71 +832,84 @@ class WSIHandler:
 
         # self.slide.properties
 
-        file = os.path.join(self.config["output_path"], slide_name, "slide_info.json")
-        with open(file, "w") as json_file:
-            json.dump(dict, json_file, indent=4)
+        _write_json(dict, os.path.join(self.config["output_path"], slide_name, "slide_info.json"))
 
     def save_thumbnail(self, mask, slide_name, level, output_format="png", save_mask=True):
         remap_color = ((0, 0, 0), (255, 255, 255))
 
+        # Blur, contours and encoding work on a preview of at most _THUMBNAIL_SIZE pixels per side instead of the
+        # full level. The image is read from the coarsest pyramid level that still has the preview resolution
+        width, height = self.level_dimensions[level]
+        scale = min(1, _THUMBNAIL_SIZE / max(width, height))
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+
         process_level = level
-        img = self.slide.read_region([0, 0], process_level, self.slide.level_dimensions[process_level])
+        if scale < 1:
+            downsample = self.level_downsamples[level] / scale
+            process_level = max(level, self.slide.get_best_level_for_downsample(downsample))
 
-        # Remove Alpha
-        img = np.array(img)[:, :, 0:3]
+        # Writable copy, the background is remapped in place below
+        img = self.read_region_rgb((0, 0), process_level, self.level_dimensions[process_level]).copy()
 
         if remap_color is not None:
             indizes = np.all(img == remap_color[0], axis=2)
             img[indizes] = remap_color[1]
 
-            copy_img = img[mask.astype(bool), :]
+        # The mask is resized without interpolation to stay binary
+        if (img.shape[1], img.shape[0]) != size:
+            img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        if (mask.shape[1], mask.shape[0]) != size:
+            mask = cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST)
 
+        if remap_color is not None:
+            # Smooth the background only, tissue pixels are copied back without gathering them into a temporary
             median_filtered_img = cv2.medianBlur(img, 11)
-            median_filtered_img[mask.astype(bool)] = copy_img
+            np.copyto(median_filtered_img, img, where=mask.astype(bool)[:, :, None])
 
             img = median_filtered_img
 
         file_name = os.path.join(self.config["output_path"], slide_name, "thumbnail." + output_format)
-        plt.imsave(file_name, img, format=output_format)
+        cv2.imwrite(file_name, cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
 
         if save_mask:
             contours, _ = cv2.findContours(mask, mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_SIMPLE)
             cv2.drawContours(img, contours, -1, (0, 255, 0), 3)
             file_name = os.path.join(self.config["output_path"], slide_name, "mask_img." + output_format)
-            plt.imsave(file_name, img, format=output_format)
+            cv2.imwrite(file_name, cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
 
-    def init_generic_tiff(self):
+    def init_generic_tiff(self, properties):
         unit_dict = {"millimeter": 1000, "centimeter": 10000, "meter": 1000000}
         scanner = "generic-tiff"
 
-        assert self.slide.properties["tiff.ResolutionUnit"] in unit_dict.keys(), (
-            "Unknown unit " + self.slide.properties["tiff.ResolutionUnit"]
+        assert properties["tiff.ResolutionUnit"] in unit_dict.keys(), (
+            "Unknown unit " + properties["tiff.ResolutionUnit"]
         )
 
-        factor = unit_dict[self.slide.properties["tiff.ResolutionUnit"]]
+        factor = unit_dict[properties["tiff.ResolutionUnit"]]
 
         # convert to mpp
-        res_x = factor / float(self.slide.properties["tiff.XResolution"])
-        res_y = factor / float(self.slide.properties["tiff.YResolution"])
+        res_x = factor / float(properties["tiff.XResolution"])
+        res_y = factor / float(properties["tiff.YResolution"])
 
         return scanner, res_x, res_y
 
-    def init_aperio(self):
+    def init_aperio(self, properties):
         scanner = "aperio"
 
-        res_x = float(self.slide.properties["openslide.mpp-x"])
-        res_y = float(self.slide.properties["openslide.mpp-y"])
+        res_x = float(properties["openslide.mpp-x"])
+        res_y = float(properties["openslide.mpp-y"])
 
         return scanner, res_x, res_y
 
-    def init_patch_calibration(self):
-        properties = list(self.slide.properties)
+    def init_patch_calibration(self, properties=None):
+        if properties is None:
+            properties = self.slide.properties
 
         # check scanner type
-        if self.slide.properties["openslide.vendor"] == "aperio":
-            scanner, res_x, res_y = self.init_aperio()
-        elif self.slide.properties["openslide.vendor"] == "generic-tiff":
-            scanner, res_x, res_y = self.init_generic_tiff()
+        if properties["openslide.vendor"] == "aperio":
+            scanner, res_x, res_y = self.init_aperio(properties)
+        elif properties["openslide.vendor"] == "generic-tiff":
+            scanner, res_x, res_y = self.init_generic_tiff(properties)
 
         # future vendors
         # elif ...
@@ -731,10 +948,15 @@ class WSIHandler:
 
         if self.config["use_tissue_detection"]:
             mask, level = self.apply_tissue_detection(
-                level=level, show=self.config["show_mode"], remove_top_border=self.config["remove_top_border"]
+                level=level,
+                show=self.config["show_mode"],
+                remove_top_border=self.config["remove_top_border"],
+                median_kernel_size=self.tissue_median_kernel,
             )
         else:
-            mask = np.ones(shape=self.slide.level_dimensions[level]).transpose()
+            # Read-only all ones view in the layout of the tissue detection mask, nothing is allocated per pixel
+            # level_dimensions is (width, height)
+            mask = np.broadcast_to(np.uint8(1), self.level_dimensions[level][::-1])
 
         tile_size = self.determine_tile_size(level)
 
@@ -746,59 +968,55 @@ class WSIHandler:
             show=self.config["show_mode"],
         )
 
-        self.make_dirs(
-            output_path=self.config["output_path"],
-            slide_name=slide_name,
-            label_dict=self.config["label_dict"],
-            annotated=annotated,
-        )
-
-        self.save_thumbnail(mask, level=level, slide_name=slide_name, output_format=self.config["output_format"])
-
-        import time
-
-        start_time = time.time()
-        # Calibrated or non calibrated patch sizes
-        if self.config["calibration"]["use_non_pixel_lengths"]:
-            patch_dict = self.extract_calibrated_patches(
-                tile_dict,
-                level,
-                self.annotation_dict,
-                self.config["label_dict"],
-                overlap=self.config["overlap"],
-                annotation_overlap=self.config["annotation_overlap"],
-                slide_name=slide_name,
-                output_format=self.config["output_format"],
-                save_patches=self.config["save_patches"],
-                zip_patches=self.config["zip_patches"],
-            )
-        else:
-            patch_dict = self.extract_patches(
-                tile_dict,
-                level,
-                self.annotation_dict,
-                self.config["label_dict"],
-                overlap=self.config["overlap"],
-                annotation_overlap=self.config["annotation_overlap"],
-                patch_size=self.config["patch_size"],
+        try:
+            self.make_dirs(
+                output_path=self.config["output_path"],
                 slide_name=slide_name,
-                output_format=self.config["output_format"],
-                save_patches=self.config["save_patches"],
+                label_dict=self.config["label_dict"],
+                annotated=annotated,
                 zip_patches=self.config["zip_patches"],
             )
-        # print("Generating patches took ", time.time() - start_time, "s")
+
+            self.save_thumbnail(mask, level=level, slide_name=slide_name, output_format=self.config["output_format"])
+
+            # Calibrated or non calibrated patch sizes
+            if self.config["calibration"]["use_non_pixel_lengths"]:
+                patch_dict = self.extract_calibrated_patches(
+                    tile_dict,
+                    level,
+                    self.annotation_dict,
+                    self.config["label_dict"],
+                    overlap=self.config["overlap"],
+                    annotation_overlap=self.config["annotation_overlap"],
+                    slide_name=slide_name,
+                    output_format=self.config["output_format"],
+                    save_patches=self.config["save_patches"],
+                    zip_patches=self.config["zip_patches"],
+                )
+            else:
+                patch_dict = self.extract_patches(
+                    tile_dict,
+                    level,
+                    self.annotation_dict,
+                    self.config["label_dict"],
+                    overlap=self.config["overlap"],
+                    annotation_overlap=self.config["annotation_overlap"],
+                    patch_size=self.config["patch_size"],
+                    slide_name=slide_name,
+                    output_format=self.config["output_format"],
+                    save_patches=self.config["save_patches"],
+                    zip_patches=self.config["zip_patches"],
+                )
+        finally:
+            # Also on errors, such that the zip files get their central directory
+            self.close_zip_files()
 
         if patch_dict is not None:
             self.export_dict(patch_dict, self.config["metadata_format"], "tile_information")
         else:
             print("patch_dict for slide ", slide_name, " was empty.")
 
-        if self.config["zip_patches"]:
-            start_time = time.time()
-            self.zip_patch_directories()
-            # print("Zipping took ", time.time() - start_time, "s")
-
-        self.export_slide_info(slide_p, slide_name, scaling_factor=int(self.slide.level_downsamples[level]))
+        self.export_slide_info(slide_p, slide_name, scaling_factor=int(self.level_downsamples[level]))
 
         print("Finished slide ", slide_name)
 
@@ -825,24 +1043,32 @@ class WSIHandler:
                 for extension in extensions:
                     slide_list.extend(path.glob("*" + extension))
         else:
-            for extension in extensions:
-                for file in Path(self.config["slides_dir"]).resolve().glob("**/*" + extension):
-                    slide_list.append(file)
+            # One walk over the slide folder for all extensions instead of a recursive glob per extension
+            for root, _, files in os.walk(Path(self.config["slides_dir"]).resolve()):
+                for file in files:
+                    if os.path.splitext(file)[1] in extensions:
+                        slide_list.append(Path(root) / file)
         slide_list = sorted(slide_list)
 
+        # Derive the file stem and the (TCGA case_id free) slide name once per slide instead of in every loop below
+        slide_stems = {slide: slide.stem for slide in slide_list}
+        slide_ids = {slide: _slide_name(slide) for slide in slide_list}
+
         self.annotation_list = []
         if os.path.exists(self.config["annotation_dir"]):
             annotation_list = os.listdir(self.config["annotation_dir"])
             self.annotation_list = [os.path.splitext(annotation)[0] for annotation in annotation_list]
 
+        # Set lookup per slide instead of scanning the annotation list
+        annotation_set = set(self.annotation_list)
+        annotated_slides = []
         missing_annotations = []
-        annotated_slides = [
-            name
-            if os.path.splitext(os.path.basename(name))[0] in self.annotation_list
-            else missing_annotations.append(os.path.splitext(os.path.basename(name))[0])
-            for name in slide_list
-        ]
-        annotated_slides = list(filter(None.__ne__, annotated_slides))
+        for name in slide_list:
+            stem = slide_stems[name]
+            if stem in annotation_set:
+                annotated_slides.append(name)
+            else:
+                missing_annotations.append(stem)
 
         print("###############################################")
         print("Found", len(annotated_slides), "annotated slides")
@@ -860,22 +1086,19 @@ class WSIHandler:
         if self.config["slideinfo_file"] is not None:
             slideinfo_file = Path(self.config["slideinfo_file"])
             assert slideinfo_file.is_file(), "Provided slideinfo .csv file does not exist"
-            slide_df = pd.read_csv(slideinfo_file, dtype=str)
-            if "Addition" in slide_df.columns:
-                slide_df["Pseudonym"] = slide_df["Pseudonym"] + slide_df["Addition"].fillna("")
-            slide_names = slide_df["Pseudonym"].to_list()
+            slide_names = _read_slideinfo(slideinfo_file)["Pseudonym"].to_list()
 
+            # Hash lookups instead of scanning and removing from the list, every row stays usable once
+            remaining = collections.Counter(slide_names)
             selected_slides = []
             for slide in slide_list:
-                slide_name = slide.stem
-                if "TCGA" in str(slide):  # Remove case_id from slide_name
-                    slide_name = slide_name.split(".")[0]
-                if slide_name in slide_names:
+                slide_name = slide_ids[slide]
+                if remaining[slide_name] > 0:
                     selected_slides.append(slide)
-                    slide_names.remove(
-                        slide_name
-                    )  # Make sure mapping from Pseudonym in slide_information.csv to slide filename is unique!
+                    # Make sure mapping from Pseudonym in slide_information.csv to slide filename is unique!
+                    remaining[slide_name] -= 1
             slide_list = selected_slides
+            slide_names = [slide_name for slide_name, count in remaining.items() for _ in range(count)]
             print("Processing", len(slide_list), "selected slides")
             print("###############################################")
             print("The following slides are missing in folder: ", slide_names)
@@ -884,21 +1107,31 @@ class WSIHandler:
         if self.config["check_resolution"]:
             print("Checking pixel resolution per slide:")
             failed_slides = []
-            for slide in tqdm(slide_list):
-                slide_name = slide.stem
-                if "TCGA" in str(slide):  # Remove case_id from slide_name
-                    slide_name = slide_name.split(".")[0]
-                check = self.check_resolution(str(slide), res_range=[0.22, 0.27])
-                if check is False:
-                    failed_slides.append(slide_name)
+
+            # Opening a slide is mostly waiting for file reads in OpenSlide, check several slides at once
+            with ThreadPoolExecutor(max_workers=max(1, min(32, len(slide_list)))) as executor:
+                checks = executor.map(
+                    lambda slide: self.check_resolution(str(slide), res_range=[0.22, 0.27]), slide_list
+                )
+                for slide, check in zip(slide_list, tqdm(checks, total=len(slide_list))):
+                    if check is False:
+                        failed_slides.append(slide_ids[slide])
             print("The following slides failed the resolution check: ", failed_slides)
             print("###############################################")
 
         if not len(slide_list) == 0:
-            if _MULTIPROCESS:
-                available_threads = multiprocessing.cpu_count() - self.config["blocked_threads"]
-                pool = multiprocessing.Pool(available_threads)
-                pool.map(self.process_slide, slide_list)
+            available_threads = multiprocessing.cpu_count() - self.config["blocked_threads"]
+            if _MULTIPROCESS and len(slide_list) > 1 and available_threads > 1:
+                # Slides take minutes each, hand them out one at a time so slow slides do not hold back the others
+                # and start a fresh worker per slide to release OpenSlide caches
+                with multiprocessing.Pool(
+                    min(available_threads, len(slide_list)),
+                    initializer=_init_worker,
+                    initargs=(self,),
+                    maxtasksperchild=1,
+                ) as pool:
+                    for _ in pool.imap_unordered(_worker_process_slide, slide_list, chunksize=1):
+                        pass
 
             else:
                 for idx in range(len(slide_list)):
@@ -912,14 +1145,22 @@ class WSIHandler:
                 labels = list(self.config["label_dict"].keys())
                 if len(labels) == 2:
                     slide_dict = {}
+                    slide_names = [slide_stems[slide] for slide in slide_list]
+
+                    # Count the label folders of all slides in parallel, the work is bound by directory reads
+                    label_dirs = [
+                        os.path.join(self.config["output_path"], slide_names[i], label)
+                        for i in range(len(annotated_slides))
+                        for label in (labels[1], labels[0])
+                    ]
+                    with ThreadPoolExecutor(max_workers=max(1, min(32, len(label_dirs)))) as executor:
+                        label_counts = list(executor.map(_count_dir, label_dirs))
+
                     for i in range(len(annotated_slides)):
-                        slide = slide_list[i]
-                        slide_name = os.path.basename(slide)
-                        slide_name = os.path.splitext(slide_name)[0]
-                        slide_path = os.path.join(self.config["output_path"], slide_name)
+                        slide_name = slide_names[i]
                         # Assume label 1 is tumor label
-                        n_tumor = len(os.listdir(os.path.join(slide_path, labels[1])))
-                        n_other = len(os.listdir(os.path.join(slide_path, labels[0])))
+                        n_tumor = label_counts[2 * i]
+                        n_other = label_counts[2 * i + 1]
                         n_total = n_tumor + n_other
                         frac = n_tumor / n_total * 100
                         slide_dict.update(
@@ -933,15 +1174,14 @@ class WSIHandler:
                                 }
                             }
                         )
-                    self.output_path = self.config["output_path"]
-                    self.export_dict(slide_dict, self.config["metadata_format"], "slide_information")
+                    self.export_dict(
+                        slide_dict, self.config["metadata_format"], "slide_information", self.config["output_path"]
+                    )
                 else:
                     print("Can only write slide information for binary classification problem")
 
             # Save used config file
-            file = os.path.join(self.config["output_path"], "config.json")
-            with open(file, "w") as json_file:
-                json.dump(self.config, json_file, indent=4)
+            _write_json(self.config, os.path.join(self.config["output_path"], "config.json"))
 
             print("Finished tiling process!")
 
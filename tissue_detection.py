@@ -1,27 +1,25 @@
-import copy
-
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
 
 
-def tissue_detection(img, remove_top_border: bool = False):
+def tissue_detection(img, remove_top_border: bool = False, median_kernel_size: int = 11):
     kernel_size = 3
 
-    # remove alpha channel
-    img = img[:, :, 0:3]
+    # remove alpha channel, contiguous so the background can be replaced in place below (no copy for RGB input)
+    img = np.ascontiguousarray(img[:, :, 0:3])
 
     if remove_top_border:
         top_border = int(len(img) / 5)
         # hack for removing border artifacts
         img[0:top_border, :, :] = [0, 0, 0]
 
-    # remove black background pixel
-    black_px = np.where((img[:, :, 0] <= 5) & (img[:, :, 1] <= 5) & (img[:, :, 2] <= 5))
-    img[black_px] = [255, 255, 255]
+    # remove black background pixel, single pass mask and in place write instead of index arrays
+    black_px = cv2.inRange(img, (0, 0, 0), (5, 5, 5))
+    cv2.bitwise_or(img, (255, 255, 255, 0), dst=img, mask=black_px)
 
-    # apply median filter to remove artifacts created by transitions to background pixels
-    median_filtered_img = cv2.medianBlur(img, 11)
+    # apply median filter to remove artifacts created by transitions to background pixels. ksize <= 5 runs on
+    # OpenCV's vectorized path, larger kernels fall back to the much slower histogram median
+    median_filtered_img = cv2.medianBlur(img, median_kernel_size)
 
     # convert to HSV color space
     hsv_image = cv2.cvtColor(median_filtered_img, cv2.COLOR_RGB2HSV)